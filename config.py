@@ -9,6 +9,10 @@ data_root_path = "/ceph/e4/users/cdelitzsch/public/forClusterStudies/"
 data_save_path = "/ceph/e4/users/bschuchardt/public/MA/data/"
 output_path = "/ceph/e4/users/bschuchardt/public/MA/TopoClassifier/output"
 
+# ---------- Datasets ---------- #
+campaigns = ["mc20a", "mc20d", "mc20e", "mc23a", "mc23d", "mc23e"]
+pu_tags = ["withPU", "noPU"]
+
 # ---------- Feature Columns ---------- #
 columns = [
     "clusterE",
@@ -74,6 +78,46 @@ normal_features = [
     "cluster_LONGITUDINAL",
 ]
 
+# ---------- Dtype Policy ---------- #
+"""Dtypes applied to every column on load, on transform and on write."""
+
+default_dtype = "float32"
+column_dtypes = {
+    "nPrimVtx": "int16",
+    "campaign": "int8",
+    "PU": "int8",
+}
+
+# Working copies of a chunk held in memory at once, used to size chunks for --memory-budget
+memory_overhead = 4
+
+# ---------- Subsampling ---------- #
+"""Strata for the reservoir subsampling: n_PV bins (low < n_PV <= high) and energy classes in GeV."""
+
+subsample_npv_edges = [10, 20, 30]
+subsample_energy_edges = [100]
+subsample_size = 10000
+subsample_chunk_size = 1000000
+
+# ---------- Sharding ---------- #
+"""Merged and shuffled training shards built from the normalised files."""
+
+shard_dir = "shards"
+shard_count = 16
+shard_chunk_size = 1000000
+shard_hdf5_chunk = 262144
+
+# ---------- Transform Registry ---------- #
+"""Transform chain of every feature, applied in order for normalisation and inverted in reverse order."""
+
+transform_chains = {
+    col: (["log"] if col in log_features else [])
+    + (["standardise_inverted"] if col in normal_features else [])
+    for col in columns
+    if col in log_features or col in normal_features
+}
+transform_chains["cluster_time"] = ["cube_root", "standardise"]
+
 # ---------- Plot Configuration ---------- #
 plot_settings = {
     "avgMu": {
@@ -253,3 +297,44 @@ plot_settings = {
         "log": True,
     },
 }
+
+# ---------- Feature Sets ---------- #
+"""Named column subsets, so every reader only fetches the columns a run needs."""
+
+# Columns needed from the root file for the cuts and the response, independent of the feature set
+cut_columns = [
+    "clusterE",
+    "cluster_ENG_CALIB_TOT",
+    "cluster_CENTER_LAMBDA",
+    "cluster_FIRST_ENG_DENS",
+    "cluster_SECOND_TIME",
+    "cluster_SIGNIFICANCE",
+]
+
+# Columns computed during preprocessing and the root columns they are computed from
+derived_columns = {
+    "cluster_response": ["clusterE", "cluster_ENG_CALIB_TOT"],
+}
+
+feature_sets = {
+    "all": [
+        col
+        for col in columns
+        if col not in ["cluster_SIGNIFICANCE", "cluster_ENG_CALIB_TOT"]
+    ]
+    + ["cluster_response"],
+    "training": [
+        col
+        for col in columns
+        if col
+        not in ["cluster_SIGNIFICANCE", "cluster_ENG_CALIB_TOT", "nPrimVtx", "avgMu"]
+    ]
+    + ["cluster_response"],
+    "plotting": list(
+        dict.fromkeys(
+            ["nPrimVtx", "avgMu", "cluster_response"]
+            + [settings["feature"] for settings in plot_settings.values()]
+        )
+    ),
+    "response": ["clusterE", "nPrimVtx", "cluster_response"],
+}
@@ -1,9 +1,19 @@
 """
-Input/output methods for checking that folders exist or creating them if neccessary.
+Input/output methods for checking that folders exist or creating them if neccessary,
+for selecting the columns of a feature set, for the dtype policy and memory budget,
+and for the nPrimVtx-sorted layout of the preprocessed hdf5-files.
 """
 
 # ---------- Imports ---------- #
 import os
+import argparse
+
+import numpy as np
+
+from config import feature_sets, default_dtype, column_dtypes, memory_overhead
+
+# ---------- Layout Config ---------- #
+npv_index_name = "nPrimVtx_index"
 
 
 # ---------- I/O Functions ---------- #
@@ -18,3 +28,192 @@ def ensure_dir_exists(path):
     except Exception as e:
         print(f"Error creating directory {path}: {e}")
         raise
+
+
+def feature_columns(feature_set):
+    """Return the columns of a named feature set from config.feature_sets."""
+    if feature_set not in feature_sets:
+        raise ValueError(
+            f"Unknown feature set '{feature_set}', choose from {list(feature_sets)}"
+        )
+    return feature_sets[feature_set]
+
+
+def select_columns(f, feature_set, extra=()):
+    """Return the columns of a feature set, plus extra columns, that exist in an open hdf5-file."""
+    wanted = list(dict.fromkeys(list(feature_columns(feature_set)) + list(extra)))
+    return [col for col in wanted if col in f]
+
+
+def iter_chunks(f, cols, chunk_size):
+    """
+    Read the given columns of an open hdf5-file sequentially in chunks of chunk_size clusters.
+    Every column is cast to its dtype from the dtype policy.
+    """
+    if not cols:
+        return
+    n_clusters = len(f[cols[0]])
+    for start in range(0, n_clusters, chunk_size):
+        stop = min(start + chunk_size, n_clusters)
+        yield {col: cast_column(col, f[col][start:stop]) for col in cols}
+
+
+# ---------- Dtype Policy ---------- #
+def column_dtype(col):
+    """Return the dtype of a column from config.column_dtypes, or config.default_dtype."""
+    return np.dtype(column_dtypes.get(col, default_dtype))
+
+
+def cast_column(col, values):
+    """Cast an array to the dtype of its column, without a copy if it already has it."""
+    return np.asarray(values).astype(column_dtype(col), copy=False)
+
+
+def apply_dtypes(df):
+    """Cast every column of a DataFrame to its dtype from the dtype policy in place."""
+    for col in df.columns:
+        if df[col].dtype != column_dtype(col):
+            df[col] = df[col].astype(column_dtype(col))
+
+
+# ---------- Memory Budget ---------- #
+def parse_memory(text):
+    """Parse a memory size like '4GB', '512M' or '1000000' into bytes."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = text.strip().upper().rstrip("B").rstrip("I")
+    try:
+        if size and size[-1] in units:
+            budget = int(float(size[:-1]) * units[size[-1]])
+        else:
+            budget = int(float(size))
+    except ValueError:
+        raise ValueError(
+            f"Invalid memory size '{text}', use a size like '4GB' or '512M'"
+        ) from None
+    if budget <= 0:
+        raise ValueError(f"Invalid memory size '{text}', it has to be positive")
+    return budget
+
+
+def add_memory_budget_argument(parser, help):
+    """Add the shared --memory-budget option, parsed into bytes, to the argument parser of a script."""
+
+    def memory_budget(text):
+        try:
+            return parse_memory(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e)) from None
+
+    parser.add_argument(
+        "--memory-budget",
+        type=memory_budget,
+        default=None,
+        help=f"Memory budget like '4GB', {help}",
+    )
+
+
+def rows_for_budget(budget, cols, overhead=memory_overhead, reserved=0):
+    """
+    Return the number of clusters per chunk that fits into budget bytes for the given columns.
+    overhead is the number of working copies of a chunk held in memory at once,
+    reserved the bytes held outside the chunks for the whole pass, like sampling buffers.
+    """
+    if reserved >= budget:
+        raise ValueError(
+            f"Memory budget of {budget} bytes leaves no room for chunks "
+            f"next to {reserved} reserved bytes"
+        )
+    bytes_per_row = sum(column_dtype(col).itemsize for col in cols) * overhead
+    return max(1, int((budget - reserved) // bytes_per_row))
+
+
+# ---------- Layout Functions ---------- #
+def build_npv_index(n_PV):
+    """
+    Build the offset index for clusters sorted by nPrimVtx.
+    Entry k is the number of clusters with nPrimVtx < k, the last entry is the total number of clusters.
+    """
+    n_PV = np.asarray(n_PV)
+    max_npv = int(n_PV.max()) if len(n_PV) > 0 else 0
+    return np.searchsorted(n_PV, np.arange(max_npv + 2), side="left").astype(np.int64)
+
+
+def npv_slice(index, low=None, high=None):
+    """
+    Return the slice of clusters with low < nPrimVtx <= high from the offset index.
+    None leaves the corresponding side of the interval open.
+    """
+    last = len(index) - 1
+    start = 0 if low is None else index[min(max(int(low) + 1, 0), last)]
+    stop = index[last] if high is None else index[min(max(int(high) + 1, 0), last)]
+    return slice(int(start), int(max(start, stop)))
+
+
+def npv_mask(n_PV, low=None, high=None):
+    """Boolean mask of clusters with low < nPrimVtx <= high."""
+    mask = np.ones(len(n_PV), dtype=bool)
+    if low is not None:
+        mask &= n_PV > low
+    if high is not None:
+        mask &= n_PV <= high
+    return mask
+
+
+def read_npv_bins(f, cols, bins):
+    """
+    Read the given columns from an open hdf5-file for every n_PV bin (low, high) with low < nPrimVtx <= high.
+    Uses one contiguous slice per bin if the file has the nPrimVtx-sorted layout.
+    Otherwise every column is read once and masked per bin.
+    """
+    if npv_index_name in f:
+        index = f[npv_index_name][:]
+        selections = [npv_slice(index, low, high) for low, high in bins]
+        return [
+            {col: cast_column(col, f[col][selected]) for col in cols}
+            for selected in selections
+        ]
+
+    data = {col: cast_column(col, f[col][:]) for col in cols}
+    if all(low is None and high is None for low, high in bins):
+        return [data for _ in bins]
+    n_PV = f["nPrimVtx"][:]
+    masks = [npv_mask(n_PV, low, high) for low, high in bins]
+    return [{col: values[mask] for col, values in data.items()} for mask in masks]
+
+
+def npv_bin_columns(f, cols, bins):
+    """
+    Return the columns read from an open hdf5-file to split the given columns into n_PV bins,
+    which includes nPrimVtx for the masks if the file does not have the nPrimVtx-sorted layout.
+    """
+    if npv_index_name in f or all(low is None and high is None for low, high in bins):
+        return list(cols)
+    return list(dict.fromkeys(list(cols) + ["nPrimVtx"]))
+
+
+def iter_npv_bins(f, cols, chunk_size, bins):
+    """
+    Read the given columns for every n_PV bin (low, high) in chunks of chunk_size clusters.
+    Yields (bin number, chunk) pairs, with one contiguous slice per bin if the file has the
+    nPrimVtx-sorted layout and a single masked pass over the file otherwise.
+    Size chunk_size for the columns from npv_bin_columns, which are the ones actually read.
+    """
+    if npv_index_name in f:
+        index = f[npv_index_name][:]
+        for i, (low, high) in enumerate(bins):
+            selected = npv_slice(index, low, high)
+            for start in range(selected.start, selected.stop, chunk_size):
+                stop = min(start + chunk_size, selected.stop)
+                yield i, {col: cast_column(col, f[col][start:stop]) for col in cols}
+        return
+
+    if all(low is None and high is None for low, high in bins):
+        for chunk in iter_chunks(f, cols, chunk_size):
+            for i in range(len(bins)):
+                yield i, chunk
+        return
+
+    for chunk in iter_chunks(f, npv_bin_columns(f, cols, bins), chunk_size):
+        for i, (low, high) in enumerate(bins):
+            mask = npv_mask(chunk["nPrimVtx"], low, high)
+            yield i, {col: chunk[col][mask] for col in cols}
@@ -11,7 +11,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from config import data_save_path, output_path
-from io_utils import ensure_dir_exists
+from io_utils import (
+    ensure_dir_exists,
+    read_npv_bins,
+    iter_npv_bins,
+    npv_bin_columns,
+    add_memory_budget_argument,
+    rows_for_budget,
+)
+from profiling import add_profile_argument, run_profiled
 
 # ---------- File Config ---------- #
 data20 = "mc20e_withPU_raw.h5"
@@ -19,6 +27,14 @@ data23 = "mc23e_withPU_raw.h5"
 data_noPU_20 = "mc20e_noPU_raw.h5"
 data_noPU_23 = "mc23e_noPU_raw.h5"
 
+# n_PV bins as (low, high, label) with low < n_PV <= high, None for an open side
+response_npv_bins = [
+    (None, 10, r"$ 1 < n_{\mathrm{PV}} \leq 10$"),
+    (10, 20, r"$10 < n_{\mathrm{PV}} \leq 20$"),
+    (20, 30, r"$20 < n_{\mathrm{PV}} \leq 30$"),
+    (30, None, r"$n_{\mathrm{PV}} > 30$"),
+]
+
 
 # ---------- Argument Parser ---------- #
 parser = argparse.ArgumentParser(description="Plot cluster features for MC20e/MC23e.")
@@ -59,12 +75,23 @@ mode_group.add_argument(
     help="Plot mean and median cluster response in n_PV bins for clusters with the complete energy ramge,"
     "clusters with energy lower than 100~GeV, and clusters with energy greater than or equal to 100~GeV ",
 )
+parser.add_argument(
+    "--subsample",
+    action="store_true",
+    help="Use the stratified subsamples from subsample.py and weight every histogram with sample_weight.",
+)
+add_memory_budget_argument(
+    parser,
+    "histograms are then filled in chunks that fit into it. "
+    "--PU_response still loads whole n_PV bins, since the median needs every cluster of a bin.",
+)
+add_profile_argument(parser)
 args = parser.parse_args()
 
 
 # ---------- Helper Functions ---------- #
-def load_feature(feature, campaign, PU=True):
-    """Load feature for MC20e or MC23e from HDF5 file."""
+def data_file(campaign, PU=True):
+    """Return the path of the HDF5 file for MC20e or MC23e."""
     if PU == False:
         if campaign == 20:
             data = data_noPU_20
@@ -76,11 +103,84 @@ def load_feature(feature, campaign, PU=True):
         elif campaign == 23:
             data = data23
 
-    file_path = os.path.join(data_save_path, data)
-    print(f"Load {feature} for MC{campaign}e from {file_path}...")
+    if args.subsample:
+        data = data.replace(".h5", "_sub.h5")
+
+    return os.path.join(data_save_path, data)
+
+
+def load_npv_bins(features, campaign, npv_bins, PU=True):
+    """
+    Load features for every n_PV bin (low, high) with low < n_PV <= high, plus sample_weight for subsamples.
+    Files with the nPrimVtx-sorted layout are read as one contiguous slice per bin,
+    other files are read once and masked per bin.
+    """
+    cols = features + ["sample_weight"] if args.subsample else features
+    file_path = data_file(campaign, PU)
+    print(f"Load {', '.join(cols)} for MC{campaign}e from {file_path}...")
+
+    with h5py.File(file_path, "r") as f:
+        return read_npv_bins(f, cols, npv_bins)
+
+
+def hist_feature(
+    feature,
+    campaign,
+    bins,
+    hrange=None,
+    PU=True,
+    npv_bins=((None, None, None),),
+    **hist_kwargs,
+):
+    """
+    Plot one histogram of a feature per n_PV bin (low, high, label), weighted with the sampling weights for subsamples.
+    With --memory-budget the histograms are filled in chunks that fit into the budget,
+    which needs hrange if bins is a number of bins.
+    """
+    bounds = [(low, high) for low, high, _ in npv_bins]
+    labels = [label for _, _, label in npv_bins]
+
+    if args.memory_budget is None:
+        data_in_bins = load_npv_bins([feature], campaign, bounds, PU)
+        for data, label in zip(data_in_bins, labels):
+            plt.hist(
+                data[feature],
+                weights=data.get("sample_weight"),
+                bins=bins,
+                range=hrange,
+                label=label,
+                **hist_kwargs,
+            )
+        return
+
+    if np.ndim(bins) == 0:
+        edges = np.linspace(hrange[0], hrange[1], bins + 1)
+    else:
+        edges = np.asarray(bins)
+    cols = [feature, "sample_weight"] if args.subsample else [feature]
 
+    file_path = data_file(campaign, PU)
+    print(f"Fill {feature} for MC{campaign}e from {file_path} in chunks...")
+    counts = np.zeros((len(bounds), len(edges) - 1))
     with h5py.File(file_path, "r") as f:
-        return f[feature][:]
+        chunk_size = rows_for_budget(
+            args.memory_budget, npv_bin_columns(f, cols, bounds)
+        )
+        for i, chunk in iter_npv_bins(f, cols, chunk_size, bounds):
+            counts[i] += np.histogram(
+                chunk[feature], bins=edges, weights=chunk.get("sample_weight")
+            )[0]
+    for bin_counts, label in zip(counts, labels):
+        plt.hist(edges[:-1], bins=edges, weights=bin_counts, label=label, **hist_kwargs)
+
+
+def weighted_median(values, weights=None):
+    """Median of values, weighted with weights if given."""
+    if weights is None:
+        return np.median(values)
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cumulative, 0.5 * cumulative[-1])]
 
 
 def plot_feature(
@@ -98,16 +198,18 @@ def plot_feature(
     print(f"Plot {feature} for MC{campaign}e...")
     if xlabel is None:
         xlabel = feature
-    feature_data = load_feature(feature=feature, campaign=campaign)
-
+    hrange = None
     if log:
         bins = np.logspace(np.log10(start), np.log10(stop), nbins)
         plt.xscale("log")
     else:
         bins = nbins
         plt.xlim([start, stop])
+        # Chunked histograms need fixed bin edges instead of the data range
+        if args.memory_budget is not None:
+            hrange = [start, stop]
 
-    plt.hist(feature_data, density=density, bins=bins, histtype="step")
+    hist_feature(feature, campaign, bins, hrange, density=density, histtype="step")
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     plt.tight_layout()
@@ -115,46 +217,20 @@ def plot_feature(
 
 def plot_response(campaign):
     """Plots response for one MC campaign and for different n_PV bins."""
-    response = load_feature("cluster_response", campaign)
-    n_PV = load_feature("nPrimVtx", campaign)
-
     nbins = 100
     beginning = 0
     end = 100
     hrange = [beginning, end]
     lim = (beginning, end)
 
-    plt.hist(
-        response[(n_PV <= 10)],
-        bins=nbins,
-        range=hrange,
-        histtype="step",
-        density=True,
-        label=r"$ 1 < n_{\mathrm{PV}} \leq 10$",
-    )
-    plt.hist(
-        response[(n_PV <= 20) & (n_PV > 10)],
-        bins=nbins,
-        range=hrange,
-        histtype="step",
-        density=True,
-        label=r"$10 < n_{\mathrm{PV}} \leq 20$",
-    )
-    plt.hist(
-        response[(n_PV <= 30) & (n_PV > 20)],
-        bins=nbins,
-        range=hrange,
+    hist_feature(
+        "cluster_response",
+        campaign,
+        nbins,
+        hrange,
+        npv_bins=response_npv_bins,
         histtype="step",
         density=True,
-        label=r"$20 < n_{\mathrm{PV}} \leq 30$",
-    )
-    plt.hist(
-        response[(n_PV > 30)],
-        bins=nbins,
-        range=hrange,
-        histtype="step",
-        density=True,
-        label=r"$n_{\mathrm{PV}} > 30$",
     )
     plt.yscale("log")
     plt.xlabel(r"Response")
@@ -168,55 +244,30 @@ def plot_response(campaign):
 
 def plot_response_with_and_with_out_PU(campaign):
     """Plots response for one MC campaign and for different n_PV bins."""
-    response = load_feature("cluster_response", campaign)
-    response_noPU = load_feature("cluster_response", campaign, PU=False)
-    n_PV = load_feature("nPrimVtx", campaign)
-
     nbins = 100
     beginning = 0
     end = 100
     hrange = [beginning, end]
     lim = (beginning, end)
 
-    plt.hist(
-        response[(n_PV <= 10)],
-        bins=nbins,
-        range=hrange,
-        histtype="step",
-        density=True,
-        label=r"$ 1 < n_{\mathrm{PV}} \leq 10$",
-    )
-    plt.hist(
-        response[(n_PV <= 20) & (n_PV > 10)],
-        bins=nbins,
-        range=hrange,
-        histtype="step",
-        density=True,
-        label=r"$10 < n_{\mathrm{PV}} \leq 20$",
-    )
-    plt.hist(
-        response[(n_PV <= 30) & (n_PV > 20)],
-        bins=nbins,
-        range=hrange,
-        histtype="step",
-        density=True,
-        label=r"$20 < n_{\mathrm{PV}} \leq 30$",
-    )
-    plt.hist(
-        response[(n_PV > 30)],
-        bins=nbins,
-        range=hrange,
+    hist_feature(
+        "cluster_response",
+        campaign,
+        nbins,
+        hrange,
+        npv_bins=response_npv_bins,
         histtype="step",
         density=True,
-        label=r"$n_{\mathrm{PV}} > 30$",
     )
-    plt.hist(
-        response_noPU,
-        bins=nbins,
-        range=hrange,
+    hist_feature(
+        "cluster_response",
+        campaign,
+        nbins,
+        hrange,
+        PU=False,
+        npv_bins=[(None, None, "No pile-up")],
         histtype="step",
         density=True,
-        label="No pile-up",
     )
     plt.yscale("log")
     plt.xlabel(r"Response")
@@ -229,43 +280,49 @@ def plot_response_with_and_with_out_PU(campaign):
 
 
 def plot_mean_meadian_response(campaign, energy):
-    """Plots mean and median response in n_PV bins between 10 and 50 for cluster with the complete energy range, clusters with energy less than 100~GeV, and clusters with energy greater than or equal to 100~GeV"""
-    if energy == "all":
-        response = load_feature("cluster_response", campaign)
-        clusterE = load_feature("clusterE", campaign)
-        n_PV = load_feature("nPrimVtx", campaign)
-    elif energy == "<100~GeV":
-        response = load_feature("cluster_response", campaign)
-        clusterE = load_feature("clusterE", campaign)
-        n_PV = load_feature("nPrimVtx", campaign)
-
-        # Apply cuts
-        response = response[clusterE < 100]
-        n_PV = n_PV[clusterE < 100]
-
-    elif energy == ">=100~GeV":
-        response = load_feature("cluster_response", campaign)
-        clusterE = load_feature("clusterE", campaign)
-        n_PV = load_feature("nPrimVtx", campaign)
-
-        # Apply cuts
-        response = response[clusterE >= 100]
-        n_PV = n_PV[clusterE >= 100]
-
+    """
+    Plots mean and median response in n_PV bins between 10 and 50 for cluster with the complete energy range, clusters with energy less than 100~GeV, and clusters with energy greater than or equal to 100~GeV.
+    Does not follow --memory-budget: the (weighted) median needs every cluster of an n_PV bin in memory.
+    """
+    if args.memory_budget is not None:
+        print(
+            "Mean and median response load whole n_PV bins, --memory-budget is not applied."
+        )
     n_PV_bins = np.arange(10, 50, 5)
     mean_response = []
     median_response = []
     n_PV_centers = []
 
+    # n_PV is integer, so n_PV_min <= n_PV < n_PV_max is n_PV_min - 1 < n_PV <= n_PV_max - 1
+    bounds = [
+        (n_PV_min - 1, n_PV_max - 1)
+        for n_PV_min, n_PV_max in zip(n_PV_bins[:-1], n_PV_bins[1:])
+    ]
+    features = ["cluster_response"]
+    if energy != "all":
+        features.append("clusterE")
+    data_in_bins = load_npv_bins(features, campaign, bounds)
+
     for i in range(len(n_PV_bins) - 1):
         n_PV_min, n_PV_max = n_PV_bins[i], n_PV_bins[i + 1]
-        n_PV_mask = (n_PV >= n_PV_min) & (n_PV < n_PV_max)
-        responses_in_bin = response[n_PV_mask]
+        responses_in_bin = data_in_bins[i]["cluster_response"]
+        weights_in_bin = data_in_bins[i].get("sample_weight")
+
+        # Apply cuts
+        if energy != "all":
+            clusterE = data_in_bins[i]["clusterE"]
+            if energy == "<100~GeV":
+                energy_mask = clusterE < 100
+            elif energy == ">=100~GeV":
+                energy_mask = clusterE >= 100
+            responses_in_bin = responses_in_bin[energy_mask]
+            if weights_in_bin is not None:
+                weights_in_bin = weights_in_bin[energy_mask]
 
         # Avoid empty bins
         if len(responses_in_bin) > 0:
-            mean_val = np.mean(responses_in_bin)
-            median_val = np.median(responses_in_bin)
+            mean_val = np.average(responses_in_bin, weights=weights_in_bin)
+            median_val = weighted_median(responses_in_bin, weights_in_bin)
         else:
             mean_val = np.nan
             median_val = np.nan
@@ -346,4 +403,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    run_profiled(main, "plot", profile=args.profile)
@@ -12,14 +12,29 @@ import numpy as np
 import pandas as pd
 
 from config import (
+    campaigns,
+    pu_tags,
     columns,
-    log_features,
-    normal_features,
+    cut_columns,
+    derived_columns,
+    transform_chains,
+    feature_sets,
     data_root_path as root_path,
     data_save_path as save_path,
 )
 
-from io_utils import ensure_dir_exists
+from io_utils import (
+    ensure_dir_exists,
+    build_npv_index,
+    npv_index_name,
+    feature_columns,
+    iter_chunks,
+    apply_dtypes,
+    add_memory_budget_argument,
+    rows_for_budget,
+)
+from profiling import add_profile_argument, run_profiled
+from transforms import fit_transform, fit_chunked, transform, save_params
 
 # ---------- Argument Parser ---------- #
 parser = argparse.ArgumentParser(description="Perform preprocessing of root files.")
@@ -35,7 +50,27 @@ parser.add_argument(
     action="store_true",
     help="Skip normalisation and time transformation",
 )
+parser.add_argument(
+    "--sort-npv",
+    action="store_true",
+    help="Sort clusters by nPrimVtx and store an offset index for contiguous n_PV bin reads",
+)
+parser.add_argument(
+    "--features",
+    default="all",
+    choices=list(feature_sets),
+    help="Named feature set from config.feature_sets to read and store",
+)
+add_memory_budget_argument(
+    parser,
+    "the root files are then processed in chunks that fit into it",
+)
+add_profile_argument(parser)
 args = parser.parse_args()
+if args.sort_npv and "nPrimVtx" not in feature_columns(args.features):
+    parser.error(
+        f"--sort-npv needs nPrimVtx, which feature set '{args.features}' drops"
+    )
 
 
 # ---------- Helper Functions ---------- #
@@ -56,79 +91,195 @@ def compute_response(df):
     df.drop("cluster_ENG_CALIB_TOT", axis=1, inplace=True)
 
 
-def apply_log(df, feature):
-    """Apply log10 scale to given features in dataset."""
-    x = df[feature]
-    min_val = x.min()
-    epsilon = 1e-12
-    if min_val <= 0:
-        shift = abs(min_val) + epsilon
-        print(
-            f"Shifting '{feature}' by {shift} before log transform to avoid non-positive values."
-        )
-        df[feature] = np.log10(x + shift)
-    else:
-        df[feature] = np.log10(x)
+def sort_by_npv(df):
+    """Sort clusters by nPrimVtx and return the offset index of every n_PV value."""
+    df.sort_values("nPrimVtx", kind="stable", inplace=True, ignore_index=True)
+    return build_npv_index(df["nPrimVtx"].values)
+
+
+def root_columns(feature_set):
+    """Return the root columns needed for a feature set, including the columns used for cuts."""
+    needed = set(cut_columns)
+    for col in feature_columns(feature_set):
+        needed.update(derived_columns.get(col, [col]))
+    return [col for col in columns if col in needed]
+
+
+def prepare_clusters(df, feature_set):
+    """Apply cuts, compute the response, keep the columns of feature_set and apply the dtype policy."""
+    apply_cuts(df)
+    compute_response(df)
+    df.drop(
+        [col for col in df.columns if col not in feature_columns(feature_set)],
+        axis=1,
+        inplace=True,
+    )
+    apply_dtypes(df)
+
+
+def normalise(df):
+    """
+    Apply the transform chain of every feature from config.transform_chains in memory,
+    as one fused pass per column. Returns the fitted parameters of every column.
+    """
+    params = {}
+    for col in [col for col in df.columns if col in transform_chains]:
+        values, params[col] = fit_transform(col, df[col].values)
+        df[col] = values
+    print("Log transformation, normalization and time normalization applied...")
+    return params
+
+
+def stream_root_file(tree, output_path, feature_set, chunk_size):
+    """Stream the tree in chunks through cuts and response and append them to an hdf5-file."""
+    n_written = 0
+    with h5py.File(output_path, "w") as f:
+        for df in tree.iterate(
+            root_columns(feature_set), step_size=chunk_size, library="pd"
+        ):
+            prepare_clusters(df, feature_set)
+            for col in df.columns:
+                if col not in f:
+                    f.create_dataset(
+                        col, shape=(0,), maxshape=(None,), dtype=df[col].dtype
+                    )
+                f[col].resize((n_written + len(df),))
+                f[col][n_written:] = df[col].values
+            n_written += len(df)
+            print(f"Processed {n_written} clusters...")
+
+
+def normalise_chunked(output_path, chunk_size):
+    """
+    Apply the transform chain of every feature to an hdf5-file in chunks.
+    The parameters are fitted in one pass per chain step before the fused transform pass.
+    """
+    with h5py.File(output_path, "r+") as f:
+        cols = [col for col in f.keys() if col in transform_chains]
+        params = fit_chunked(f, cols, chunk_size)
 
+        start = 0
+        for chunk in iter_chunks(f, cols, chunk_size):
+            n_chunk = len(chunk[cols[0]])
+            for col in cols:
+                values = transform(col, chunk[col], params[col])
+                f[col][start : start + n_chunk] = values
+            start += n_chunk
+        for col in cols:
+            save_params(f[col], col, params[col])
+    print("Log transformation, normalization and time normalization applied...")
 
-def apply_normalisation(df, feature):
-    """Apply standard scaler normalisation to features in dataset."""
-    x = df[feature]
-    df[feature] = (x.mean() - x) / x.std()
 
+def sort_by_npv_chunked(output_path, chunk_size):
+    """
+    Sort an hdf5-file by nPrimVtx in chunks with a counting sort and store the offset index.
+    Every chunk is scattered to the running write position of each n_PV value in a new file.
+    """
+    sorted_path = output_path + ".sorted"
+    with h5py.File(output_path, "r") as f_in, h5py.File(sorted_path, "w") as f_out:
+        cols = list(f_in.keys())
+        counts = np.zeros(1, dtype=np.int64)
+        for chunk in iter_chunks(f_in, ["nPrimVtx"], chunk_size):
+            chunk_counts = np.bincount(chunk["nPrimVtx"])
+            if len(chunk_counts) > len(counts):
+                counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+            counts[: len(chunk_counts)] += chunk_counts
+        npv_index = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
 
-def apply_time_normalisation(df):
-    """Applies special normalisation for cluster_time."""
-    x = df["cluster_time"]
-    transformed = np.abs(x) ** (1 / 3) * np.sign(x)
-    df["cluster_time"] = (transformed - transformed.mean()) / transformed.std()
+        for col in cols:
+            f_out.create_dataset(col, shape=f_in[col].shape, dtype=f_in[col].dtype)
+            f_out[col].attrs.update(f_in[col].attrs)
+        cursors = npv_index[:-1].copy()
+        for chunk in iter_chunks(f_in, cols, chunk_size):
+            order = np.argsort(chunk["nPrimVtx"], kind="stable")
+            chunk_bounds = np.concatenate(
+                [[0], np.cumsum(np.bincount(chunk["nPrimVtx"], minlength=len(counts)))]
+            )
+            for n_PV in np.unique(chunk["nPrimVtx"]):
+                rows = order[chunk_bounds[n_PV] : chunk_bounds[n_PV + 1]]
+                begin, end = cursors[n_PV], cursors[n_PV] + len(rows)
+                for col in cols:
+                    f_out[col][begin:end] = chunk[col][rows]
+                cursors[n_PV] = end
+        f_out.create_dataset(npv_index_name, data=npv_index)
+    os.replace(sorted_path, output_path)
 
 
-def preprocess_root_file(file_path, output_base_name, apply_norm=True):
-    """Preprocesses root file with or without normalisation depending on apply_norm=True or False."""
+def preprocess_root_file(
+    file_path,
+    output_base_name,
+    apply_norm=True,
+    sort_npv=False,
+    feature_set="all",
+    memory_budget=None,
+):
+    """
+    Preprocesses root file with or without normalisation depending on apply_norm=True or False.
+    With sort_npv=True the clusters are stored sorted by nPrimVtx together with an offset index.
+    Only the root columns needed for feature_set are read and only its columns are stored.
+    With a memory_budget in bytes the file is processed in chunks that fit into the budget.
+    """
     print(f"Preprocessing: {file_path}")
     root_file = uproot.open(file_path)
     tree = root_file["ClusterTree;1"]
-    df = tree.arrays(columns, library="pd")
-    print("Data loaded...")
-
-    apply_cuts(df)
-    print("Cuts applied...")
 
-    compute_response(df)
-    print("Response computed...")
+    # Make sure the directory exists before saving
+    ensure_dir_exists(save_path)
 
     tag = "_norm" if apply_norm else "_raw"
+    output_name = f"{output_base_name}{tag}.h5"
+    output_path = os.path.join(save_path, output_name)
+    if sort_npv and "nPrimVtx" not in feature_columns(feature_set):
+        print(f"Feature set '{feature_set}' has no nPrimVtx, clusters are not sorted.")
+        sort_npv = False
 
-    if apply_norm:
-        for feature in log_features:
-            apply_log(df, feature)
-        print("Log transformation applied...")
+    if memory_budget is not None:
+        chunk_size = rows_for_budget(memory_budget, root_columns(feature_set))
+        print(f"Processing in chunks of {chunk_size} clusters...")
+        stream_root_file(tree, output_path, feature_set, chunk_size)
+        print("Cuts applied and response computed...")
+        if apply_norm:
+            normalise_chunked(output_path, chunk_size)
+        else:
+            print("Skipping log scale, normalization and time transformation.")
+        if sort_npv:
+            sort_by_npv_chunked(output_path, chunk_size)
+            print("Clusters sorted by nPrimVtx...")
+        print(f"Saved preprocessed data to {output_path}\n")
+        return
 
-        for feature in normal_features:
-            apply_normalisation(df, feature)
-        print("Normalization applied...")
+    df = tree.arrays(root_columns(feature_set), library="pd")
+    print("Data loaded...")
 
-        apply_time_normalisation(df)
-        print("Special time normalization applied...")
+    prepare_clusters(df, feature_set)
+    print("Cuts applied and response computed...")
+
+    params = {}
+    if apply_norm:
+        params = normalise(df)
     else:
         print("Skipping log scale, normalization and time transformation.")
 
-    # Make sure the directory exists before saving
-    ensure_dir_exists(save_path)
+    npv_index = None
+    if sort_npv:
+        npv_index = sort_by_npv(df)
+        print("Clusters sorted by nPrimVtx...")
 
-    os.makedirs(save_path, exist_ok=True)
-    output_name = f"{output_base_name}{tag}.h5"
-    output_path = os.path.join(save_path, output_name)
     with h5py.File(output_path, "w") as f:
         for col in df.columns:
             f.create_dataset(col, data=df[col].values)
+            if col in params:
+                save_params(f[col], col, params[col])
+        if npv_index is not None:
+            f.create_dataset(npv_index_name, data=npv_index)
     print(f"Saved preprocessed data to {output_path}\n")
 
 
 # ---------- Main Function ---------- #
 def main():
     apply_norm = not args.no_normalisation
+    sort_npv = args.sort_npv
+    feature_set = args.features
 
     if args.test:
         print("Test mode activated...")
@@ -136,24 +287,33 @@ def main():
             os.path.join(root_path, "mc20e_withPU.root"),
             "mc20e_withPU",
             apply_norm=apply_norm,
+            sort_npv=sort_npv,
+            feature_set=feature_set,
+            memory_budget=args.memory_budget,
         )
         preprocess_root_file(
             os.path.join(root_path, "mc23e_withPU.root"),
             "mc23e_withPU",
             apply_norm=apply_norm,
+            sort_npv=sort_npv,
+            feature_set=feature_set,
+            memory_budget=args.memory_budget,
         )
     elif args.full:
         print("Full mode activated...")
-        for tag in ["mc20a", "mc20d", "mc20e", "mc23a", "mc23d", "mc23e"]:
-            for pu in ["withPU", "noPU"]:
+        for tag in campaigns:
+            for pu in pu_tags:
                 file_name = f"{tag}_{pu}.root"
                 output_name = f"{tag}_{pu}"
                 preprocess_root_file(
                     os.path.join(root_path, file_name),
                     output_name,
                     apply_norm=apply_norm,
+                    sort_npv=sort_npv,
+                    feature_set=feature_set,
+                    memory_budget=args.memory_budget,
                 )
 
 
 if __name__ == "__main__":
-    main()
+    run_profiled(main, "preprocessing", profile=args.profile)
@@ -0,0 +1,126 @@
+"""
+Profiling hooks shared by all scripts: cProfile or sampling profiler output and a tracemalloc report.
+"""
+
+# ---------- Imports ---------- #
+import os
+import sys
+import argparse
+import time
+import cProfile
+import pstats
+import tracemalloc
+
+from config import output_path
+from io_utils import ensure_dir_exists
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# ---------- Profile Config ---------- #
+profile_dir = "profile"
+n_top = 25
+
+
+# ---------- Profiling Functions ---------- #
+def add_profile_argument(parser):
+    """Add the shared --profile option to the argument parser of a script."""
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run and save the profile, a summary and a tracemalloc report to the output directory. "
+        "tracemalloc traces every allocation, so the timings of allocation-heavy functions are inflated",
+    )
+
+
+def write_tracemalloc_report(snapshot, report_path):
+    """Write the top allocations of a tracemalloc snapshot by line."""
+    with open(report_path, "w") as f:
+        f.write(f"Top {n_top} allocations by line\n\n")
+        for stat in snapshot.statistics("lineno")[:n_top]:
+            f.write(f"{stat}\n")
+        current, peak = tracemalloc.get_traced_memory()
+        f.write(
+            f"\nCurrent: {current / 1024**2:.1f} MiB, peak: {peak / 1024**2:.1f} MiB\n"
+        )
+
+
+def summarise_profile(pstats_path, n=n_top, stream=None):
+    """Print the hottest functions of a pstats dump, by own time and by cumulative time."""
+    stats = pstats.Stats(pstats_path, stream=stream or sys.stdout)
+    stats.strip_dirs()
+    stats.sort_stats("tottime").print_stats(n)
+    stats.sort_stats("cumulative").print_stats(n)
+
+
+def profile_base_path(name):
+    """Return the output path without extension for the profiling reports of a run."""
+    save_dir = os.path.join(output_path, profile_dir)
+    ensure_dir_exists(save_dir)
+    return os.path.join(save_dir, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}")
+
+
+def run_profiled(main, name, profile=False):
+    """
+    Run the main function of a script, profiled if profile=True.
+    The run is profiled with the pyinstrument sampling profiler if it is installed and cProfile otherwise,
+    while tracemalloc records the allocations. Both reports come from the same single run,
+    so the timings include the tracemalloc overhead.
+    """
+    if not profile:
+        return main()
+
+    base_path = profile_base_path(name)
+    tracemalloc.start()
+    if pyinstrument is not None:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        return main()
+    finally:
+        # Stop the profiler and take the snapshot before writing any report
+        if pyinstrument is not None:
+            profiler.stop()
+        else:
+            profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        write_tracemalloc_report(snapshot, f"{base_path}_tracemalloc.txt")
+        tracemalloc.stop()
+
+        if pyinstrument is not None:
+            with open(f"{base_path}.html", "w") as f:
+                f.write(profiler.output_html())
+            with open(f"{base_path}_summary.txt", "w") as f:
+                f.write(profiler.output_text())
+            print(f"Saved sampling profile to {base_path}.html")
+        else:
+            profiler.dump_stats(f"{base_path}.pstats")
+            with open(f"{base_path}_summary.txt", "w") as f:
+                summarise_profile(f"{base_path}.pstats", stream=f)
+            print(f"Saved profile to {base_path}.pstats")
+        print(f"Saved tracemalloc report to {base_path}_tracemalloc.txt")
+
+
+# ---------- Main Function ---------- #
+def main():
+    """Summarise the hottest functions of pstats dumps given on the command line."""
+    parser = argparse.ArgumentParser(
+        description="Summarise the hottest functions of pstats dumps."
+    )
+    parser.add_argument("pstats_paths", nargs="+", help="pstats dumps from --profile")
+    parser.add_argument(
+        "-n", type=int, default=n_top, help="Number of functions to show"
+    )
+    args = parser.parse_args()
+    for pstats_path in args.pstats_paths:
+        summarise_profile(pstats_path, n=args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Merge the normalised hdf5-files into pre-shuffled, fixed-size shards for training.
+"""
+
+# ---------- Imports ---------- #
+import os
+import argparse
+
+import h5py
+import numpy as np
+
+from config import (
+    campaigns,
+    pu_tags,
+    shard_dir,
+    shard_count,
+    shard_chunk_size,
+    shard_hdf5_chunk,
+    feature_sets,
+    data_save_path as save_path,
+)
+
+from io_utils import (
+    ensure_dir_exists,
+    select_columns,
+    column_dtype,
+    cast_column,
+    add_memory_budget_argument,
+    rows_for_budget,
+)
+from profiling import add_profile_argument, run_profiled
+
+# ---------- Argument Parser ---------- #
+parser = argparse.ArgumentParser(
+    description="Merge and shuffle the normalised files into training shards."
+)
+parser.add_argument(
+    "--n-shards", type=int, default=shard_count, help="Number of output shards"
+)
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=shard_chunk_size,
+    help="Number of clusters read from disk at once while scattering",
+)
+parser.add_argument(
+    "--features",
+    default="training",
+    choices=list(feature_sets),
+    help="Named feature set from config.feature_sets to read and store",
+)
+add_memory_budget_argument(
+    parser,
+    "chunks and the number of shards are chosen so every step fits into it",
+)
+parser.add_argument("--seed", type=int, default=42, help="Seed of the shuffle")
+add_profile_argument(parser)
+args = parser.parse_args()
+
+
+# ---------- Helper Functions ---------- #
+def input_files():
+    """List the normalised files with their campaign and PU tag codes."""
+    files = []
+    for campaign_code, campaign in enumerate(campaigns):
+        for pu in pu_tags:
+            file_path = os.path.join(save_path, f"{campaign}_{pu}_norm.h5")
+            files.append((file_path, campaign_code, int(pu == "withPU")))
+    return files
+
+
+def check_input_files(files, feature_set):
+    """
+    Check that every normalised file exists and stores the columns of feature_set kept in the first file.
+    Returns the columns and the number of clusters of every file.
+    """
+    missing_files = [
+        file_path for file_path, _, _ in files if not os.path.exists(file_path)
+    ]
+    if missing_files:
+        raise FileNotFoundError(
+            f"Missing normalised files {missing_files}, preprocess them first"
+        )
+
+    with h5py.File(files[0][0], "r") as f:
+        cols = select_columns(f, feature_set)
+    totals = []
+    for file_path, _, _ in files:
+        with h5py.File(file_path, "r") as f:
+            missing = [col for col in cols if col not in f]
+            if missing:
+                raise ValueError(
+                    f"{file_path} has no {', '.join(missing)}, "
+                    "preprocess every file with the same feature set"
+                )
+            totals.append(len(f[cols[0]]))
+    return cols, totals
+
+
+def scatter(files, totals, shard_files, sizes, cols, chunk_size, rng):
+    """
+    Scatter all clusters into the shards, each cluster into a random shard.
+    The shards of a chunk are drawn from the capacities left in every shard,
+    so every shard is filled exactly with only O(chunk) memory for the labels.
+    """
+    n_shards = len(sizes)
+    cursors = np.zeros(n_shards, dtype=np.int64)
+
+    for (file_path, campaign_code, pu_code), n_clusters in zip(files, totals):
+        print(f"Scattering: {file_path}")
+        with h5py.File(file_path, "r") as f:
+            for start in range(0, n_clusters, chunk_size):
+                stop = min(start + chunk_size, n_clusters)
+                chunk = {col: cast_column(col, f[col][start:stop]) for col in cols}
+                chunk["campaign"] = np.full(stop - start, campaign_code, dtype=np.int8)
+                chunk["PU"] = np.full(stop - start, pu_code, dtype=np.int8)
+                chunk_counts = rng.multivariate_hypergeometric(
+                    sizes - cursors, stop - start
+                )
+                chunk_labels = np.repeat(
+                    np.arange(n_shards, dtype=np.int32), chunk_counts
+                )
+                rng.shuffle(chunk_labels)
+
+                # Group the chunk by shard so every shard gets one contiguous write
+                order = np.argsort(chunk_labels, kind="stable")
+                bounds = np.concatenate(
+                    [[0], np.cumsum(np.bincount(chunk_labels, minlength=n_shards))]
+                )
+                for shard in range(n_shards):
+                    rows = order[bounds[shard] : bounds[shard + 1]]
+                    if len(rows) == 0:
+                        continue
+                    begin, end = cursors[shard], cursors[shard] + len(rows)
+                    for col, values in chunk.items():
+                        shard_files[shard][col][begin:end] = values[rows]
+                    cursors[shard] = end
+
+
+def shuffle_shard(f, rng):
+    """Shuffle one shard in memory, with the same permutation for every column."""
+    cols = list(f.keys())
+    permutation = rng.permutation(len(f[cols[0]]))
+    for col in cols:
+        f[col][...] = f[col][:][permutation]
+
+
+def build_shards(n_shards, chunk_size, rng, feature_set="training", memory_budget=None):
+    """
+    Build n_shards pre-shuffled shards with the columns of feature_set from all normalised files.
+    With a memory_budget in bytes the chunk size is chosen to fit into the budget
+    and the number of shards is raised until a single shard can be shuffled in memory.
+    """
+    files = input_files()
+    # Check the inputs before any shard is created
+    cols, totals = check_input_files(files, feature_set)
+    output_dir = os.path.join(save_path, shard_dir)
+    ensure_dir_exists(output_dir)
+
+    dtypes = {col: column_dtype(col) for col in cols + ["campaign", "PU"]}
+
+    if memory_budget is not None:
+        chunk_size = rows_for_budget(memory_budget, list(dtypes))
+        n_shards = max(n_shards, -(-sum(totals) // chunk_size))
+        print(f"Using {n_shards} shards and chunks of {chunk_size} clusters...")
+    sizes = np.diff(np.linspace(0, sum(totals), n_shards + 1).astype(np.int64))
+
+    shard_files = []
+    for shard, size in enumerate(sizes):
+        f = h5py.File(os.path.join(output_dir, f"shard_{shard:03d}.h5"), "w")
+        for col, dtype in dtypes.items():
+            f.create_dataset(
+                col,
+                shape=(int(size),),
+                dtype=dtype,
+                chunks=(int(max(1, min(size, shard_hdf5_chunk))),),
+            )
+        shard_files.append(f)
+
+    try:
+        scatter(files, totals, shard_files, sizes, cols, chunk_size, rng)
+        print("Clusters scattered into shards...")
+        for shard, f in enumerate(shard_files):
+            shuffle_shard(f, rng)
+            print(f"Shuffled shard {shard + 1}/{n_shards}...")
+    finally:
+        for f in shard_files:
+            f.close()
+    print(f"Saved {n_shards} shards to {output_dir}\n")
+
+
+# ---------- Main Function ---------- #
+def main():
+    rng = np.random.default_rng(args.seed)
+    build_shards(
+        args.n_shards,
+        args.chunk_size,
+        rng,
+        feature_set=args.features,
+        memory_budget=args.memory_budget,
+    )
+
+
+if __name__ == "__main__":
+    run_profiled(main, "shard", profile=args.profile)
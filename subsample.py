@@ -0,0 +1,250 @@
+"""
+Build small development datasets from the preprocessed hdf5-files with stratified reservoir sampling.
+"""
+
+# ---------- Imports ---------- #
+import os
+import argparse
+
+import h5py
+import numpy as np
+
+from config import (
+    campaigns,
+    pu_tags,
+    subsample_npv_edges,
+    subsample_energy_edges,
+    subsample_size,
+    subsample_chunk_size,
+    feature_sets,
+    data_save_path as save_path,
+)
+
+from io_utils import (
+    ensure_dir_exists,
+    build_npv_index,
+    npv_index_name,
+    select_columns,
+    iter_chunks,
+    column_dtype,
+    cast_column,
+    add_memory_budget_argument,
+    rows_for_budget,
+)
+from profiling import add_profile_argument, run_profiled
+
+# ---------- Argument Parser ---------- #
+parser = argparse.ArgumentParser(
+    description="Draw a fixed-size subsample per n_PV bin and energy class from preprocessed files."
+)
+mode_group = parser.add_mutually_exclusive_group(required=True)
+mode_group.add_argument(
+    "--test",
+    action="store_true",
+    help="Run in test mode (process only mc20e and mc23e)",
+)
+mode_group.add_argument(
+    "--full", action="store_true", help="Subsample all preprocessed datasets"
+)
+parser.add_argument(
+    "--norm",
+    action="store_true",
+    help="Subsample the normalised files instead of the raw files (no energy classes)",
+)
+parser.add_argument(
+    "--size",
+    type=int,
+    default=subsample_size,
+    help="Number of clusters kept per stratum",
+)
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=subsample_chunk_size,
+    help="Number of clusters read from disk at once",
+)
+parser.add_argument(
+    "--features",
+    default="all",
+    choices=list(feature_sets),
+    help="Named feature set from config.feature_sets to read and store",
+)
+add_memory_budget_argument(
+    parser,
+    "used to size the chunks instead of --chunk-size",
+)
+parser.add_argument("--seed", type=int, default=42, help="Seed of the random sampler")
+add_profile_argument(parser)
+args = parser.parse_args()
+
+
+# ---------- Helper Functions ---------- #
+def assign_strata(n_PV, clusterE=None):
+    """Assign every cluster to a stratum from its n_PV bin and energy class."""
+    npv_class = np.digitize(n_PV, subsample_npv_edges, right=True)
+    if clusterE is None:
+        return npv_class
+    energy_class = np.digitize(clusterE, subsample_energy_edges)
+    return npv_class * (len(subsample_energy_edges) + 1) + energy_class
+
+
+def n_strata(use_energy=True):
+    """Number of strata from the n_PV bins and, with use_energy=True, the energy classes."""
+    n_npv = len(subsample_npv_edges) + 1
+    return n_npv * (len(subsample_energy_edges) + 1) if use_energy else n_npv
+
+
+def reservoir_bytes(cols, size, use_energy=True):
+    """
+    Bytes of the reservoirs of all strata with size clusters of the given columns and their keys.
+    Counted twice, for the copies made while merging and while concatenating the subsample.
+    """
+    bytes_per_row = sum(column_dtype(col).itemsize for col in cols)
+    bytes_per_row += np.dtype(np.float64).itemsize
+    return 2 * n_strata(use_energy) * size * bytes_per_row
+
+
+def update_reservoir(reservoir, keys, data, size):
+    """
+    Merge new candidates into a reservoir and keep the size clusters with the smallest random keys.
+    Keeping the smallest uniform keys is equivalent to reservoir sampling without replacement.
+    """
+    if reservoir is None:
+        merged_keys = keys
+        merged_data = data
+    else:
+        merged_keys = np.concatenate([reservoir[0], keys])
+        merged_data = {
+            col: np.concatenate([reservoir[1][col], data[col]]) for col in data
+        }
+
+    if len(merged_keys) > size:
+        keep = np.argpartition(merged_keys, size - 1)[:size]
+        merged_keys = merged_keys[keep]
+        merged_data = {col: values[keep] for col, values in merged_data.items()}
+    return merged_keys, merged_data
+
+
+def subsample_file(
+    input_name,
+    output_name,
+    size,
+    chunk_size,
+    rng,
+    use_energy=True,
+    feature_set="all",
+    memory_budget=None,
+):
+    """
+    Stream through one preprocessed file in chunks and keep size clusters per stratum.
+    The subsample is written in the same schema with an extra sample_weight dataset.
+    Only the columns of feature_set and the columns defining the strata are read.
+    With a memory_budget in bytes the chunk size is chosen to fit into the budget next to the reservoirs.
+    """
+    input_path = os.path.join(save_path, input_name)
+    print(f"Subsampling: {input_path}")
+
+    reservoirs = {}
+    counts = {}
+    with h5py.File(input_path, "r") as f:
+        if "nPrimVtx" not in f:
+            raise ValueError(
+                f"{input_path} has no nPrimVtx to define the strata, "
+                "preprocess it with a feature set that keeps nPrimVtx"
+            )
+        if use_energy and "clusterE" not in f:
+            print(f"{input_path} has no clusterE, energy classes are skipped.")
+            use_energy = False
+        strata_cols = ["nPrimVtx", "clusterE"] if use_energy else ["nPrimVtx"]
+        cols = select_columns(f, feature_set, extra=strata_cols)
+        if memory_budget is not None:
+            chunk_size = rows_for_budget(
+                memory_budget, cols, reserved=reservoir_bytes(cols, size, use_energy)
+            )
+        # Keep the fitted transform parameters so subsamples can be mapped back to physical units
+        attrs = {col: dict(f[col].attrs) for col in cols}
+        n_clusters = len(f["nPrimVtx"])
+        for start, chunk in zip(
+            range(0, n_clusters, chunk_size), iter_chunks(f, cols, chunk_size)
+        ):
+            stop = start + len(chunk["nPrimVtx"])
+            strata = assign_strata(
+                chunk["nPrimVtx"], chunk["clusterE"] if use_energy else None
+            )
+            keys = rng.random(stop - start)
+
+            for stratum in np.unique(strata):
+                sel = strata == stratum
+                counts[stratum] = counts.get(stratum, 0) + int(sel.sum())
+                reservoirs[stratum] = update_reservoir(
+                    reservoirs.get(stratum),
+                    keys[sel],
+                    {col: values[sel] for col, values in chunk.items()},
+                    size,
+                )
+            print(f"Processed {stop}/{n_clusters} clusters...")
+
+    # Each kept cluster represents counts/kept clusters of its stratum
+    strata = sorted(reservoirs)
+    sample = {
+        col: np.concatenate([reservoirs[s][1][col] for s in strata]) for col in cols
+    }
+    sample["sample_weight"] = np.concatenate(
+        [
+            np.full(len(reservoirs[s][0]), counts[s] / len(reservoirs[s][0]))
+            for s in strata
+        ]
+    )
+    for s in strata:
+        print(f"Stratum {s}: kept {len(reservoirs[s][0])} of {counts[s]} clusters")
+
+    # Store the subsample sorted by nPrimVtx so n_PV bins are contiguous slices
+    order = np.argsort(sample["nPrimVtx"], kind="stable")
+
+    ensure_dir_exists(save_path)
+    output_path = os.path.join(save_path, output_name)
+    with h5py.File(output_path, "w") as f:
+        for col, values in sample.items():
+            f.create_dataset(col, data=cast_column(col, values[order]))
+            f[col].attrs.update(attrs.get(col, {}))
+        f.create_dataset(
+            npv_index_name, data=build_npv_index(sample["nPrimVtx"][order])
+        )
+    print(f"Saved subsample to {output_path}\n")
+
+
+# ---------- Main Function ---------- #
+def main():
+    rng = np.random.default_rng(args.seed)
+    tag = "_norm" if args.norm else "_raw"
+    if args.norm:
+        print(
+            "clusterE is transformed in normalised files, energy classes are skipped."
+        )
+
+    if args.test:
+        print("Test mode activated...")
+        names = [
+            f"{campaign}_{pu}"
+            for campaign in ["mc20e", "mc23e"]
+            for pu in ["withPU", "noPU"]
+        ]
+    elif args.full:
+        print("Full mode activated...")
+        names = [f"{campaign}_{pu}" for campaign in campaigns for pu in pu_tags]
+
+    for name in names:
+        subsample_file(
+            f"{name}{tag}.h5",
+            f"{name}{tag}_sub.h5",
+            size=args.size,
+            chunk_size=args.chunk_size,
+            rng=rng,
+            use_energy=not args.norm,
+            feature_set=args.features,
+            memory_budget=args.memory_budget,
+        )
+
+
+if __name__ == "__main__":
+    run_profiled(main, "subsample", profile=args.profile)
@@ -6,7 +6,9 @@ Train different ML models on given input features.
 import os
 import argparse
 
+import glob
 import math
+import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -14,11 +16,162 @@ import tensorflow as tf
 from tensorflow import keras
 from keras import layers
 
+from config import feature_sets, shard_dir, data_save_path
+from io_utils import (
+    feature_columns,
+    select_columns,
+    cast_column,
+    iter_chunks,
+    add_memory_budget_argument,
+    rows_for_budget,
+)
+from profiling import add_profile_argument, run_profiled
+
+# ---------- Argument Parser ---------- #
+parser = argparse.ArgumentParser(
+    description="Train ML models on the training shards or the subsamples."
+)
+parser.add_argument(
+    "--features",
+    default="training",
+    choices=list(feature_sets),
+    help="Named feature set from config.feature_sets to read from the shards or subsamples",
+)
+parser.add_argument("--batch-size", type=int, default=1024, help="Training batch size")
+parser.add_argument(
+    "--subsample",
+    action="store_true",
+    help="Train on the normalised subsamples from subsample.py, weighted with sample_weight, instead of the shards",
+)
+parser.add_argument(
+    "--seed", type=int, default=42, help="Seed of the subsample shuffle"
+)
+add_memory_budget_argument(
+    parser,
+    "used to size the chunks read from the shards",
+)
+add_profile_argument(parser)
+args = parser.parse_args()
+if args.subsample and args.memory_budget is not None:
+    parser.error(
+        "--memory-budget sizes the shard reads, --subsample loads the subsamples into memory"
+    )
+
+
 # ---------- Helper Functions ---------- #
+def training_columns(f, feature_set, target, source):
+    """
+    Return the feature columns of feature_set that an open hdf5-file stores, without the target.
+    Columns of feature_set that the file does not store are skipped.
+    """
+    if target not in f:
+        raise ValueError(f"The {source} have no target {target}")
+    available = select_columns(f, feature_set)
+    missing = [col for col in feature_columns(feature_set) if col not in available]
+    if missing:
+        print(f"The {source} have no {', '.join(missing)}, these features are skipped.")
+    return [col for col in available if col != target]
+
+
+def load_dataset(
+    feature_set="training",
+    target="cluster_response",
+    batch_size=1024,
+    chunk_size=262144,
+    memory_budget=None,
+):
+    """
+    Build a tf.data pipeline over the shards that reads only the columns of feature_set.
+    Columns of feature_set that the shards do not store are skipped.
+    Every shard is read sequentially in chunks of chunk_size clusters and split into batches.
+    With a memory_budget in bytes the chunk size is chosen to fit into the budget.
+    """
+    shard_dir_path = os.path.join(data_save_path, shard_dir)
+    shard_paths = sorted(glob.glob(os.path.join(shard_dir_path, "*.h5")))
+    if not shard_paths:
+        raise FileNotFoundError(
+            f"No shards in {shard_dir_path}, build them with shard.py"
+        )
+
+    # The shards only store the feature set they were built with
+    with h5py.File(shard_paths[0], "r") as f:
+        features = training_columns(f, feature_set, target, "shards")
+    if memory_budget is not None:
+        chunk_size = rows_for_budget(memory_budget, features + [target])
+
+    def generator():
+        for shard_path in shard_paths:
+            with h5py.File(shard_path, "r") as f:
+                for chunk in iter_chunks(f, features + [target], chunk_size):
+                    x = np.stack([chunk[col] for col in features], axis=1)
+                    y = chunk[target]
+                    for start in range(0, len(y), batch_size):
+                        stop = start + batch_size
+                        yield x[start:stop], y[start:stop]
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(
+            tf.TensorSpec(shape=(None, len(features)), dtype=tf.float32),
+            tf.TensorSpec(shape=(None,), dtype=tf.float32),
+        ),
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def load_subsample_dataset(
+    feature_set="training", target="cluster_response", batch_size=1024, seed=42
+):
+    """
+    Build a tf.data pipeline over the normalised subsamples from subsample.py for quick iteration.
+    The subsamples are small, so they are loaded into memory and shuffled as a whole.
+    Every batch yields (x, y, sample_weight) so the loss is reweighted to the full datasets.
+    """
+    sub_paths = sorted(glob.glob(os.path.join(data_save_path, "*_norm_sub.h5")))
+    if not sub_paths:
+        raise FileNotFoundError(
+            f"No normalised subsamples in {data_save_path}, build them with subsample.py --norm"
+        )
+    print(f"Training on the subsamples {', '.join(map(os.path.basename, sub_paths))}")
+
+    with h5py.File(sub_paths[0], "r") as f:
+        features = training_columns(f, feature_set, target, "subsamples")
+    cols = features + [target, "sample_weight"]
+    data = {col: [] for col in cols}
+    for sub_path in sub_paths:
+        with h5py.File(sub_path, "r") as f:
+            missing = [col for col in cols if col not in f]
+            if missing:
+                raise ValueError(
+                    f"{sub_path} has no {', '.join(missing)}, "
+                    "subsample every file with the same feature set"
+                )
+            for col in cols:
+                data[col].append(cast_column(col, f[col][:]))
+    data = {col: np.concatenate(values) for col, values in data.items()}
+
+    x = np.stack([data[col] for col in features], axis=1)
+    y = data[target]
+    sample_weight = data["sample_weight"].astype(np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((x, y, sample_weight))
+    dataset = dataset.shuffle(len(y), seed=seed).batch(batch_size)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
 
 # ---------- Main Function ---------- #
 def main():
-    print("Here is a main function!")
+    if args.subsample:
+        dataset = load_subsample_dataset(
+            feature_set=args.features, batch_size=args.batch_size, seed=args.seed
+        )
+    else:
+        dataset = load_dataset(
+            feature_set=args.features,
+            batch_size=args.batch_size,
+            memory_budget=args.memory_budget,
+        )
+    print(f"Training dataset: {dataset.element_spec}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_profiled(main, "train", profile=args.profile)
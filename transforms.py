@@ -0,0 +1,213 @@
+"""
+Registry of feature transforms from config.transform_chains with fused in-place passes and exact inverses.
+"""
+
+# ---------- Imports ---------- #
+import json
+
+import numpy as np
+
+from config import transform_chains
+from io_utils import cast_column, iter_chunks
+
+# ---------- Transform Steps ---------- #
+"""
+Every step collects statistics with init/update, turns them into parameters with params,
+and transforms a float64 array in place with forward and inverse.
+"""
+
+
+def log_update(stats, x):
+    """Track the minimum for the shift before the log transform."""
+    return min(stats, float(x.min())) if len(x) > 0 else stats
+
+
+def log_params(stats, feature):
+    """Shift that makes a feature positive before the log transform."""
+    epsilon = 1e-12
+    shift = 0.0
+    if stats <= 0:
+        shift = abs(stats) + epsilon
+        print(
+            f"Shifting '{feature}' by {shift} before log transform to avoid non-positive values."
+        )
+    return {"shift": shift}
+
+
+def log_forward(x, params):
+    """Apply log10 scale after the shift."""
+    if params["shift"] > 0:
+        np.add(x, params["shift"], out=x)
+    np.log10(x, out=x)
+
+
+def log_inverse(x, params):
+    """Undo the log10 scale and the shift."""
+    np.power(10.0, x, out=x)
+    if params["shift"] > 0:
+        np.subtract(x, params["shift"], out=x)
+
+
+def moments_update(stats, x):
+    """Merge the mean and variance of a chunk into running (count, mean, M2) statistics."""
+    if len(x) == 0:
+        return stats
+    n, mean, m2 = stats
+    n_chunk = len(x)
+    mean_chunk = x.mean()
+    m2_chunk = np.square(x - mean_chunk).sum()
+    delta = mean_chunk - mean
+    n_total = n + n_chunk
+    mean += delta * n_chunk / n_total
+    m2 += m2_chunk + delta**2 * n * n_chunk / n_total
+    return n_total, mean, m2
+
+
+def moments_params(stats, feature):
+    """Mean and sample standard deviation, like pandas."""
+    n, mean, m2 = stats
+    return {"mean": float(mean), "std": float(np.sqrt(m2 / (n - 1)))}
+
+
+def standardise_forward(x, params):
+    """Standard scaler (x - mean) / std."""
+    np.subtract(x, params["mean"], out=x)
+    np.divide(x, params["std"], out=x)
+
+
+def standardise_inverse(x, params):
+    """Undo the standard scaler."""
+    np.multiply(x, params["std"], out=x)
+    np.add(x, params["mean"], out=x)
+
+
+def standardise_inverted_forward(x, params):
+    """Standard scaler with inverted sign (mean - x) / std."""
+    np.subtract(params["mean"], x, out=x)
+    np.divide(x, params["std"], out=x)
+
+
+def standardise_inverted_inverse(x, params):
+    """Undo the standard scaler with inverted sign."""
+    np.multiply(x, params["std"], out=x)
+    np.subtract(params["mean"], x, out=x)
+
+
+def cube_root_forward(x, params):
+    """Signed cube root used for cluster_time."""
+    np.cbrt(x, out=x)
+
+
+def cube_root_inverse(x, params):
+    """Undo the signed cube root."""
+    np.power(x, 3, out=x)
+
+
+transform_steps = {
+    "log": {
+        "init": lambda: np.inf,
+        "update": log_update,
+        "params": log_params,
+        "forward": log_forward,
+        "inverse": log_inverse,
+    },
+    "standardise": {
+        "init": lambda: (0, 0.0, 0.0),
+        "update": moments_update,
+        "params": moments_params,
+        "forward": standardise_forward,
+        "inverse": standardise_inverse,
+    },
+    "standardise_inverted": {
+        "init": lambda: (0, 0.0, 0.0),
+        "update": moments_update,
+        "params": moments_params,
+        "forward": standardise_inverted_forward,
+        "inverse": standardise_inverted_inverse,
+    },
+    "cube_root": {
+        "init": lambda: None,
+        "update": lambda stats, x: None,
+        "params": lambda stats, feature: {},
+        "forward": cube_root_forward,
+        "inverse": cube_root_inverse,
+    },
+}
+
+
+# ---------- Transform Functions ---------- #
+def feature_chain(feature):
+    """Return the transform chain of a feature, empty if it is not transformed."""
+    return transform_chains.get(feature, [])
+
+
+def fit_transform(feature, values):
+    """
+    Fit and apply the whole transform chain of a feature in one fused pass.
+    All steps work in place on a single float64 buffer, the result is cast with the dtype policy.
+    Returns the transformed values and the fitted parameters of every step.
+    """
+    x = np.array(values, dtype=np.float64)
+    params = []
+    for step_name in feature_chain(feature):
+        step = transform_steps[step_name]
+        step_params = step["params"](step["update"](step["init"](), x), feature)
+        step["forward"](x, step_params)
+        params.append(step_params)
+    return cast_column(feature, x), params
+
+
+def transform(feature, values, params):
+    """Apply the transform chain of a feature with fitted parameters in one fused pass."""
+    x = np.array(values, dtype=np.float64)
+    for step_name, step_params in zip(feature_chain(feature), params):
+        transform_steps[step_name]["forward"](x, step_params)
+    return cast_column(feature, x)
+
+
+def inverse_transform(feature, values, params):
+    """Map transformed values back to physical units by inverting the chain in reverse order."""
+    x = np.array(values, dtype=np.float64)
+    for step_name, step_params in reversed(list(zip(feature_chain(feature), params))):
+        transform_steps[step_name]["inverse"](x, step_params)
+    return x
+
+
+def fit_chunked(f, cols, chunk_size):
+    """
+    Fit the transform chains of the given columns of an open hdf5-file in chunks.
+    Pass i collects the statistics of step i of every chain, with the earlier steps already applied.
+    """
+    cols = [col for col in cols if feature_chain(col)]
+    params = {col: [] for col in cols}
+    n_passes = max([len(feature_chain(col)) for col in cols], default=0)
+    for i in range(n_passes):
+        active = [col for col in cols if len(feature_chain(col)) > i]
+        stats = {
+            col: transform_steps[feature_chain(col)[i]]["init"]() for col in active
+        }
+        for chunk in iter_chunks(f, active, chunk_size):
+            for col in active:
+                x = np.array(chunk[col], dtype=np.float64)
+                for step_name, step_params in zip(feature_chain(col), params[col]):
+                    transform_steps[step_name]["forward"](x, step_params)
+                stats[col] = transform_steps[feature_chain(col)[i]]["update"](
+                    stats[col], x
+                )
+        for col in active:
+            step = transform_steps[feature_chain(col)[i]]
+            params[col].append(step["params"](stats[col], col))
+    return params
+
+
+def save_params(dataset, feature, params):
+    """Store the transform chain and its fitted parameters as attributes of an hdf5 dataset."""
+    dataset.attrs["transform_chain"] = json.dumps(feature_chain(feature))
+    dataset.attrs["transform_params"] = json.dumps(params)
+
+
+def load_params(dataset):
+    """Load the fitted transform parameters of an hdf5 dataset, empty if it was not transformed."""
+    if "transform_params" not in dataset.attrs:
+        return []
+    return json.loads(dataset.attrs["transform_params"])